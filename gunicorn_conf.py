@@ -0,0 +1,11 @@
+import os
+
+# job state lives in the worker process (yt._jobs), so keep a single worker
+# and scale with connections/threads inside it
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+workers = 1
+worker_class = os.environ.get("WORKER_CLASS", "gevent")
+worker_connections = 1000
+threads = int(os.environ.get("THREADS", 16))  # gthread only
+timeout = 900
+keepalive = 75
@@ -1,18 +1,40 @@
-from flask import Flask, request, jsonify, send_file
-import yt_dlp
 import os
-import uuid
+
+# gunicorn's gevent worker patches before importing us; GEVENT=1 does the
+# same for --preload or a bare "python yt.py", before yt_dlp opens sockets
+if os.environ.get("GEVENT") == "1":
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, request, jsonify, send_file
+from flask.json.provider import JSONProvider
+import orjson
+import yt_dlp
+import hashlib
 import time
 import subprocess
 import logging
-import re
-from threading import Thread
+import string
+import struct
+import copy
+import glob
+import heapq
+import shutil
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Thread, Condition, Lock
 
 # =========================
 # CONFIG
 # =========================
 
-DOWNLOAD_DIR = "./downloads"
+# DOWNLOAD_DIR=/dev/shm/downloads keeps files in RAM; opt-in only, tmpfs
+# counts against the container's memory limit and filling it OOM-kills the
+# worker along with every job in it
+DOWNLOAD_DIR = os.environ.get("DOWNLOAD_DIR") or "./downloads"
 PORT = int(os.environ.get("PORT", 5000))
 BASE_URL = os.environ.get("RAILWAY_STATIC_URL", "").strip()
 
@@ -35,43 +57,557 @@ log = logging.getLogger("YT")
 # APP
 # =========================
 
+class OrjsonProvider(JSONProvider):
+    # /status is polled every second or so per client, keep encoding in C
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# /download takes a single URL, anything bigger is junk
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024
+
+# behind nginx/Apache, hand the file to the frontend and skip Python entirely.
+# nginx wants an internal location instead of a path, e.g. X_ACCEL_PREFIX=
+# /internal/downloads/ with "location /internal/downloads/ { internal;
+# alias <DOWNLOAD_DIR>/; }"; the alias must be the absolute DOWNLOAD_DIR
+# (/app/downloads/ for the default on Railway) or every file 404s
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE") == "1"
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "")
+
+# =========================
+# FETCH CONCURRENCY
+# =========================
+
+# additive increase while throughput keeps rising, halve on throttling;
+# the ceiling stays low since YouTube bot-checks aggressive clients
+FETCH_MIN = 1
+FETCH_MAX = int(os.environ.get("DL_WORKERS", 8))
+FETCH_TICK = 10
+THROTTLE_HINTS = ("HTTP Error 429", "confirm you're not a bot")
+
+_fetch_cv = Condition()
+_fetch_limit = 2
+_fetch_active = 0
+_fetch_bytes = 0
+_fetch_throttled = False
+_fetch_seen = {}  # filename -> bytes already counted
+
+def fetch_progress(d: dict):
+    # throughput from the "downloading" deltas, so each tick counts the
+    # bytes that arrived during it. aria2c only sends "finished", so its
+    # streams can't be measured: each lands whole in the tick it completes
+    global _fetch_bytes
+    name = d.get("filename")
+    with _fetch_cv:
+        seen = _fetch_seen.get(name, 0)
+        if d["status"] == "downloading":
+            now = d.get("downloaded_bytes") or 0
+            _fetch_seen[name] = max(seen, now)
+        elif d["status"] == "finished":
+            now = d.get("total_bytes") or d.get("downloaded_bytes") or 0
+            _fetch_seen.pop(name, None)
+        else:
+            _fetch_seen.pop(name, None)
+            return
+        _fetch_bytes += max(0, now - seen)
+
+def acquire_fetch_slot():
+    global _fetch_active
+    with _fetch_cv:
+        while _fetch_active >= _fetch_limit:
+            _fetch_cv.wait()
+        _fetch_active += 1
+
+def release_fetch_slot():
+    global _fetch_active
+    with _fetch_cv:
+        _fetch_active -= 1
+        _fetch_cv.notify()
+
+def report_throttle(e: Exception):
+    global _fetch_throttled
+    if any(h in str(e) for h in THROTTLE_HINTS):
+        with _fetch_cv:
+            _fetch_throttled = True
+
+def concurrency_loop():
+    global _fetch_limit, _fetch_bytes, _fetch_throttled
+    last_rate = 0.0
+    while True:
+        time.sleep(FETCH_TICK)
+        with _fetch_cv:
+            rate = _fetch_bytes / FETCH_TICK
+            if _fetch_throttled:
+                _fetch_limit = max(FETCH_MIN, _fetch_limit // 2)
+            elif rate > last_rate and _fetch_active >= _fetch_limit:
+                _fetch_limit = min(FETCH_MAX, _fetch_limit + 1)
+            _fetch_bytes = 0
+            _fetch_throttled = False
+            # streams that died without a "finished"/"error" event
+            if not _fetch_active:
+                _fetch_seen.clear()
+            _fetch_cv.notify_all()
+        last_rate = rate
+
+Thread(target=concurrency_loop, daemon=True).start()
+
+# =========================
+# JOBS
+# =========================
+
+# /download only queues work; the request returns at once and clients
+# poll /status/<id>. Job state lives in this process, which is why the
+# Procfile runs a single gevent worker. Sized for the fetch ceiling, the
+# adaptive limit decides how many jobs actually download at once
+DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=FETCH_MAX, thread_name_prefix="ytdl")
+
+_jobs = {}
+_jobs_lock = Lock()
+
+def job_uid(filename: str) -> str:
+    # every file yt-dlp writes is named <uid>.<...>, recover the job from it
+    return os.path.basename(filename or "").split(".", 1)[0]
+
+class JobSize(yt_dlp.postprocessor.PostProcessor):
+    # before_dl runs once formats are picked, the only point that sees every
+    # selected stream; progress is measured against their combined size
+    def run(self, info):
+        job = _jobs.get(job_uid(info.get("_filename")))
+        if job:
+            total = sum(f.get("filesize") or f.get("filesize_approx") or 0
+                        for f in info.get("requested_formats") or (info,))
+            job["total"] = total or None
+        return [], info
+
+def job_progress(d: dict):
+    job = _jobs.get(job_uid(d.get("filename")))
+    if not job or d["status"] not in ("downloading", "finished"):
+        return
+    # aria2c only reports "finished", and yt-dlp counts each stream from
+    # zero; bank finished streams so the count only grows across both
+    done = job.get("done", 0)
+    if d["status"] == "finished":
+        done = job["done"] = done + (d.get("total_bytes") or d.get("downloaded_bytes") or 0)
+        downloaded = done
+    else:
+        downloaded = done + (d.get("downloaded_bytes") or 0)
+    job["downloaded"] = max(job.get("downloaded", 0), downloaded)
+
+    total = job.get("total") or done + (d.get("total_bytes") or d.get("total_bytes_estimate") or 0)
+    if total:
+        # sizes can be estimates, 100 is only reported once the MP4 is ready
+        progress = min(99, job["downloaded"] * 100 // max(total, job["downloaded"]))
+        job["progress"] = max(job["progress"], progress)
+
+def run_job(uid: str, url: str, job: dict):
+    job["status"] = "downloading"
+    final_path = os.path.join(DOWNLOAD_DIR, f"{uid}.mp4")
+
+    try:
+        # -------------------------
+        # DOWNLOAD + MUX
+        # -------------------------
+        if file_size(final_path):
+            # same video already on disk (e.g. from before a restart)
+            info = probe(url)
+        else:
+            # yt-dlp writes the streams to .part files, merges into a temp
+            # MP4 and renames it, so /file never sees a half-written file
+            info = fetch("media", probe(url), final_path)
+
+        title = info.get("title", "YouTube Video")
+
+        size = file_size(final_path)
+        if not size:
+            raise RuntimeError("Final MP4 invalid")
+
+        res = video_resolution(info, final_path)
+
+        job["result"] = {
+            "success": True,
+            "title": title[:200],
+            "resolution": res,
+            "size_mb": round(size / (1024 * 1024), 2),
+            "download_url": f"{BASE_URL}/file/{uid}.mp4" if BASE_URL else f"/file/{uid}.mp4",
+            "codec": "H.264 + AAC",
+            "container": "MP4 faststart",
+            "whatsapp": "guaranteed"
+        }
+        job["progress"] = 100
+        job["status"] = "ready"
+
+    except Exception as e:
+        log.error(e, exc_info=True)
+        forget_info(url)
+        # yt-dlp keeps .part files around for resuming, nothing will resume
+        for leftover in glob.glob(os.path.join(DOWNLOAD_DIR, f"{uid}.*")):
+            if leftover != final_path:
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+        job["status"] = "failed"
+
+    finally:
+        # the lifetime starts when the file (or the failure) is there to hand
+        # out, a slow queue must not expire the job under its pollers
+        schedule_expiry(uid, time.time() + FILE_LIFETIME)
 
 # =========================
 # CLEANUP THREAD
 # =========================
 
 FILE_LIFETIME = 30 * 60
+SWEEP_INTERVAL = 60 * 60
+# .part/.ytdl/temp files keep getting written while their download runs,
+# one that has sat untouched this long belongs to a dead process
+PART_LIFETIME = 10 * 60
+
+# (deadline, job id) min-heap: the thread sleeps until the earliest expiry
+# instead of waking up to stat the whole directory
+_expiry = []
+_expiry_cv = Condition()
+
+def schedule_expiry(uid: str, deadline: float):
+    with _expiry_cv:
+        heapq.heappush(_expiry, (deadline, uid))
+        _expiry_cv.notify()
+
+def expire(uid: str):
+    path = os.path.join(DOWNLOAD_DIR, f"{uid}.mp4")
+    with _jobs_lock:
+        job = _jobs.get(uid)
+        # stale entry (a replaced failed job, the boot sweep): the running
+        # job schedules its own expiry when it finishes
+        if job and job["status"] in ("queued", "downloading"):
+            return
+        last_used = job["created"] if job else 0
+        try:
+            last_used = max(last_used, os.stat(path).st_mtime)
+        except OSError:
+            pass
+        # handed out again since it was scheduled, push it back
+        if time.time() - last_used < FILE_LIFETIME:
+            schedule_expiry(uid, last_used + FILE_LIFETIME)
+            return
+        _jobs.pop(uid, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def sweep_leftovers():
+    # files from a previous process: drop the expired ones, schedule the rest
+    now = time.time()
+    with os.scandir(DOWNLOAD_DIR) as it:
+        for e in it:
+            try:
+                if not e.is_file(follow_symlinks=False):
+                    continue
+                mtime = e.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+            uid, _, ext = e.name.partition(".")
+            if now - mtime > (FILE_LIFETIME if ext == "mp4" else PART_LIFETIME):
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+            elif ext == "mp4":
+                schedule_expiry(uid, mtime + FILE_LIFETIME)
+
+def sweep_stale():
+    # safety net for anything the heap lost track of (failed removes, files
+    # dropped in by hand); expire() still honours jobs handed out again
+    now = time.time()
+    with os.scandir(DOWNLOAD_DIR) as it:
+        for e in it:
+            # yt-dlp renames and deletes .part/.temp files while we walk
+            try:
+                if not e.is_file(follow_symlinks=False):
+                    continue
+                age = now - e.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+            uid, _, ext = e.name.partition(".")
+            if age <= (FILE_LIFETIME if ext == "mp4" else PART_LIFETIME):
+                continue
+            if ext == "mp4":
+                expire(uid)
+                continue
+            job = _jobs.get(uid)
+            if job and job["status"] in ("queued", "downloading"):
+                continue
+            try:
+                os.remove(e.path)
+            except OSError:
+                pass
 
 def cleanup_loop():
+    try:
+        sweep_leftovers()
+    except Exception:
+        log.exception("boot sweep failed")
+    next_sweep = time.time() + SWEEP_INTERVAL
     while True:
-        now = time.time()
-        for f in os.listdir(DOWNLOAD_DIR):
-            path = os.path.join(DOWNLOAD_DIR, f)
-            if os.path.isfile(path) and now - os.path.getmtime(path) > FILE_LIFETIME:
-                try:
-                    os.remove(path)
-                except:
-                    pass
-        time.sleep(300)
+        # a bad pass must not kill the thread, nothing would expire after it
+        try:
+            now = time.time()
+            if now >= next_sweep:
+                next_sweep = now + SWEEP_INTERVAL
+                sweep_stale()
+            with _expiry_cv:
+                if not _expiry or _expiry[0][0] > now:
+                    timeout = next_sweep - now
+                    if _expiry:
+                        timeout = min(timeout, _expiry[0][0] - now)
+                    _expiry_cv.wait(timeout=timeout)
+                    continue
+                deadline, uid = heapq.heappop(_expiry)
+            expire(uid)
+        except Exception:
+            log.exception("cleanup pass failed")
 
 Thread(target=cleanup_loop, daemon=True).start()
 
+# =========================
+# YT-DLP
+# =========================
+
+# DASH/HLS fragments are fetched in parallel; when aria2c is installed it
+# also splits progressive MP4s into ranged requests over several sockets
+FRAGMENT_WORKERS = int(os.environ.get("YTDLP_CONCURRENT_FRAGS", 16))
+ARIA2C = shutil.which("aria2c")
+# resolved once at boot instead of a PATH lookup per subprocess; /health
+# reports it so a missing apt package shows up before the first merge fails
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+
+# per stream cap, applied by the format selector from the sizes YouTube
+# reports, so an oversized stream is never requested: the best format that
+# fits wins, and the job fails when none does. "<?" lets unsized ones through
+MAX_FILE_MB = int(os.environ.get("MAX_FILE_MB", 500))
+_SIZE_CAP = f"[filesize<?{MAX_FILE_MB}MiB][filesize_approx<?{MAX_FILE_MB}MiB]"
+
+YDL_OPTS = {
+    # metadata only, formats are picked by the fetchers below. the mp4
+    # streams come from the player response itself, the HLS/DASH manifests
+    # would only cost extra round trips
+    "info": {
+        "noplaylist": True,
+        "extractor_args": {"youtube": {"skip": ["hls", "dash", "translated_subs"]}},
+        "quiet": True,
+        "no_warnings": True
+    },
+    # ≤1080p H.264 + AAC, merged by yt-dlp into a faststart MP4 (WHATSAPP FIX)
+    "media": {
+        "format": (
+            f"bestvideo[vcodec^=avc1][height<=1080][ext=mp4]{_SIZE_CAP}"
+            f"+bestaudio[acodec^=mp4a]{_SIZE_CAP}"
+            f"/best[vcodec^=avc1][height<=1080][ext=mp4]{_SIZE_CAP}"
+        ),
+        "merge_output_format": "mp4",
+        "postprocessor_args": {"merger+ffmpeg_o": ["-movflags", "+faststart"]},
+        "outtmpl": os.path.join(DOWNLOAD_DIR, "%(id)s.%(ext)s"),
+        "concurrent_fragment_downloads": FRAGMENT_WORKERS,
+        "progress_hooks": [fetch_progress, job_progress],
+        # hooks still fire, only the console progress line is skipped
+        "noprogress": True,
+        "quiet": True,
+        "no_warnings": True
+    }
+}
+
+if FFMPEG:
+    YDL_OPTS["media"]["ffmpeg_location"] = FFMPEG
+
+if ARIA2C:
+    YDL_OPTS["media"]["external_downloader"] = {"default": "aria2c"}
+    YDL_OPTS["media"]["external_downloader_args"] = {
+        "aria2c": ["-x", "16", "-s", "16", "-k", "1M", "--min-split-size=1M"]
+    }
+
+# idle YoutubeDL instances per option set; building one loads every
+# extractor and sets up the opener, so keep that out of the request path
+_ydl_pool = {name: queue.SimpleQueue() for name in YDL_OPTS}
+
+def new_ydl(name: str):
+    ydl = yt_dlp.YoutubeDL(dict(YDL_OPTS[name]))
+    if name == "media":
+        ydl.add_post_processor(JobSize(), when="before_dl")
+    return ydl
+
+@contextmanager
+def pooled_ydl(name: str, outtmpl: str = None):
+    try:
+        ydl = _ydl_pool[name].get_nowait()
+    except queue.Empty:
+        ydl = new_ydl(name)
+    # instances are not shared between threads, only the output path changes
+    if outtmpl:
+        ydl.params["outtmpl"]["default"] = outtmpl
+    try:
+        yield ydl
+    finally:
+        _ydl_pool[name].put(ydl)
+
+def warm_ydl_pool():
+    # pay extractor registration and the YouTube extractor import at boot,
+    # not on the first request of every (re)started worker
+    for name in YDL_OPTS:
+        ydl = new_ydl(name)
+        ydl.get_info_extractor("Youtube")
+        _ydl_pool[name].put(ydl)
+
+warm_ydl_pool()
+
+def fetch(name: str, info: dict, outtmpl: str) -> dict:
+    acquire_fetch_slot()
+    try:
+        with pooled_ydl(name, outtmpl) as ydl:
+            # format selection mutates the dict, keep the cached copy clean
+            return ydl.process_ie_result(copy.deepcopy(info), download=True)
+    except yt_dlp.utils.DownloadError as e:
+        report_throttle(e)
+        raise
+    finally:
+        release_fetch_slot()
+
+# =========================
+# INFO CACHE
+# =========================
+
+# the same Short tends to get sent by many users in a row; keep the raw
+# extraction (formats included) so repeats skip the player API entirely.
+# signed stream URLs stay valid for hours, well past the TTL
+INFO_TTL = 10 * 60
+INFO_CACHE_SIZE = 128
+
+_info_cache = OrderedDict()
+_info_lock = Lock()
+
+def probe(url: str) -> dict:
+    key = video_id(url) or url
+    now = time.time()
+    with _info_lock:
+        hit = _info_cache.get(key)
+        if hit and hit[0] > now:
+            _info_cache.move_to_end(key)
+            return hit[1]
+
+    try:
+        with pooled_ydl("info") as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+    except yt_dlp.utils.DownloadError as e:
+        report_throttle(e)
+        raise
+
+    with _info_lock:
+        _info_cache[key] = (now + INFO_TTL, info)
+        _info_cache.move_to_end(key)
+        while len(_info_cache) > INFO_CACHE_SIZE:
+            _info_cache.popitem(last=False)
+    return info
+
+def forget_info(url: str):
+    # a failed download may come from stale formats, re-extract next time
+    with _info_lock:
+        _info_cache.pop(video_id(url) or url, None)
+
 # =========================
 # UTILS
 # =========================
 
+# plain substring and set checks, no regex engine on the request path
+_ID_PREFIXES = ("youtube.com/shorts/", "youtu.be/", "youtube.com/watch?v=")
+_ID_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+
+# job ids are file_key() digests, served files are always <job id>.mp4
+_JOB_ID_LEN = 24
+_HEX_CHARS = frozenset("0123456789abcdef")
+
+def is_job_id(s: str) -> bool:
+    return len(s) == _JOB_ID_LEN and _HEX_CHARS.issuperset(s)
+
+# the same trending Short gets submitted over and over; real share links
+# are short, longer input skips the memo so it can't pin big strings
+_URL_CACHE_MAX_LEN = 200
+
 def normalize_url(url: str) -> str:
+    if len(url) > _URL_CACHE_MAX_LEN:
+        return _normalize_url(url)
+    return _normalize_url_cached(url)
+
+def _normalize_url(url: str) -> str:
     url = url.replace("voutu.be", "youtu.be").replace("ww.youtube.com", "www.youtube.com")
-    m = re.search(r"shorts/([A-Za-z0-9_-]+)", url)
-    if m:
-        return f"https://www.youtube.com/watch?v={m.group(1)}"
+    vid = video_id(url)
+    if vid:
+        return "https://www.youtube.com/watch?v=" + vid
     return url
 
+_normalize_url_cached = lru_cache(maxsize=4096)(_normalize_url)
+
+def video_id(url: str):
+    for prefix in _ID_PREFIXES:
+        _, found, rest = url.partition(prefix)
+        vid = rest[:11]
+        # the id must end there, "abcdefghijkLMN" is not "abcdefghijk"
+        if (found and len(vid) == 11 and _ID_CHARS.issuperset(vid)
+                and (len(rest) == 11 or rest[11] not in _ID_CHARS)):
+            return vid
+    return None
+
+def file_key(url: str) -> str:
+    # same video + same format selection -> same file, so repeats dedupe
+    key = f"{video_id(url) or url}|{YDL_OPTS['media']['format']}"
+    return hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+def file_size(path: str) -> int:
+    # one stat instead of exists() + getsize(), and no window between them
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+def mp4_height(path: str) -> int:
+    # faststart puts moov up front: walk moov -> trak -> tkhd, whose last
+    # 8 bytes are width/height in 16.16 fixed point (0 for audio tracks)
+    try:
+        with open(path, "rb") as f:
+            return _tkhd_height(f, 0, os.fstat(f.fileno()).st_size)
+    except (OSError, struct.error):
+        return 0
+
+def _tkhd_height(f, pos: int, end: int) -> int:
+    height = 0
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        head = 8
+        if size == 1:
+            size, head = struct.unpack(">Q", f.read(8))[0], 16
+        elif size == 0:
+            size = end - pos
+        if size < head:
+            break
+        if kind in (b"moov", b"trak"):
+            height = max(height, _tkhd_height(f, pos + head, pos + size))
+        elif kind == b"tkhd":
+            f.seek(pos + size - 4)
+            height = max(height, struct.unpack(">I", f.read(4))[0] >> 16)
+        pos += size
+    return height
+
 def ffprobe_height(path: str) -> str:
+    if not FFPROBE:
+        return "HD"
     try:
         r = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+            [FFPROBE, "-v", "error", "-select_streams", "v:0",
              "-show_entries", "stream=height", "-of", "csv=p=0", path],
             capture_output=True, text=True
         )
@@ -81,15 +617,40 @@ def ffprobe_height(path: str) -> str:
         pass
     return "HD"
 
+def video_resolution(info: dict, path: str) -> str:
+    # the selected format already carries its height, then the MP4 header;
+    # ffprobe only as a last resort
+    height = info.get("height")
+    for dl in info.get("requested_downloads") or ():
+        height = height or dl.get("height")
+    height = height or mp4_height(path)
+    if height:
+        return f"{height}p"
+    return ffprobe_height(path)
+
 # =========================
 # ROUTES
 # =========================
 
+# constant replies on the polling path, encoded once
+_NOT_FOUND = orjson.dumps({"error": "Not found"})
+_FAILED = orjson.dumps({"error": "Download failed", "status": "failed"})
+
+def json_bytes(body: bytes, status: int = 200) -> Response:
+    return Response(body, status=status, mimetype="application/json")
+
 @app.route("/health")
 def health():
+    # d_type from the directory read is enough, no stat per entry; only
+    # finished <job id>.mp4 outputs, not .fNNN.mp4 streams or merge temps
+    with os.scandir(DOWNLOAD_DIR) as it:
+        files = sum(1 for e in it
+                    if e.name.endswith(".mp4") and is_job_id(e.name[:-4])
+                    and e.is_file(follow_symlinks=False))
     return jsonify({
         "status": "ok",
-        "files": len(os.listdir(DOWNLOAD_DIR)),
+        "files": files,
+        "ffmpeg": FFMPEG is not None,
         "time": int(time.time())
     })
 
@@ -100,94 +661,88 @@ def download():
         return jsonify({"error": "URL required"}), 400
 
     url = normalize_url(data["url"])
-    uid = uuid.uuid4().hex
-
-    video_path = os.path.join(DOWNLOAD_DIR, f"{uid}_video.mp4")
-    audio_path = os.path.join(DOWNLOAD_DIR, f"{uid}_audio.m4a")
-    final_path = os.path.join(DOWNLOAD_DIR, f"{uid}.mp4")
-
-    try:
-        # -------------------------
-        # DOWNLOAD VIDEO (≤1080p, AVC)
-        # -------------------------
-        ydl_video = {
-            "format": "bestvideo[vcodec^=avc1][height<=1080][ext=mp4]",
-            "outtmpl": video_path,
-            "quiet": True,
-            "no_warnings": True
-        }
-
-        with yt_dlp.YoutubeDL(ydl_video) as ydl:
-            info = ydl.extract_info(url, download=True)
-
-        title = info.get("title", "YouTube Video")
-
-        # -------------------------
-        # DOWNLOAD AUDIO (AAC)
-        # -------------------------
-        ydl_audio = {
-            "format": "bestaudio[acodec^=mp4a]/bestaudio",
-            "outtmpl": audio_path,
-            "quiet": True,
-            "no_warnings": True
-        }
-
-        with yt_dlp.YoutubeDL(ydl_audio) as ydl:
-            ydl.download([url])
-
-        # -------------------------
-        # MUX + FASTSTART (WHATSAPP FIX)
-        # -------------------------
-        subprocess.run([
-            "ffmpeg", "-y",
-            "-i", video_path,
-            "-i", audio_path,
-            "-map", "0:v:0",
-            "-map", "1:a:0",
-            "-c:v", "copy",
-            "-c:a", "aac",
-            "-movflags", "+faststart",
-            final_path
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        if not os.path.exists(final_path) or os.path.getsize(final_path) == 0:
-            raise RuntimeError("Final MP4 invalid")
-
-        res = ffprobe_height(final_path)
-        size = os.path.getsize(final_path)
-
-        return jsonify({
-            "success": True,
-            "title": title[:200],
-            "resolution": res,
-            "size_mb": round(size / (1024 * 1024), 2),
-            "download_url": f"{BASE_URL}/file/{uid}.mp4" if BASE_URL else f"/file/{uid}.mp4",
-            "codec": "H.264 + AAC",
-            "container": "MP4 faststart",
-            "whatsapp": "guaranteed"
-        })
-
-    except Exception as e:
-        log.error(e, exc_info=True)
-        return jsonify({"error": "Download failed"}), 500
+    uid = file_key(url)
+    path = os.path.join(DOWNLOAD_DIR, f"{uid}.mp4")
+
+    # identical requests share one job and one file on disk
+    with _jobs_lock:
+        job = _jobs.get(uid)
+        if job and (job["status"] == "failed" or
+                    job["status"] == "ready" and not os.path.exists(path)):
+            job = None
+        now = time.time()
+        if job is None:
+            job = _jobs[uid] = {"status": "queued", "progress": 0, "created": now}
+            job["future"] = DOWNLOAD_POOL.submit(run_job, uid, url, job)
+        else:
+            # a reused file must outlive this client's fetch as well
+            job["created"] = now
+
+    # old clients can still ask for the blocking behaviour
+    if data.get("wait"):
+        job["future"].result()
+        return job_response(uid)
 
-    finally:
-        for f in (video_path, audio_path):
-            if os.path.exists(f):
-                os.remove(f)
+    return jsonify({
+        "success": True,
+        "download_id": uid,
+        "status_url": f"{BASE_URL}/status/{uid}" if BASE_URL else f"/status/{uid}"
+    }), 202
+
+@app.route("/status/<uid>")
+def status(uid):
+    if not is_job_id(uid):
+        return json_bytes(_NOT_FOUND, 404)
+    return job_response(uid)
+
+def job_response(uid: str):
+    job = _jobs.get(uid)
+    if job is None:
+        return json_bytes(_NOT_FOUND, 404)
+    if job["status"] == "ready":
+        return jsonify({**job["result"], "status": "ready"})
+    if job["status"] == "failed":
+        return json_bytes(_FAILED, 500)
+    return jsonify({
+        "success": True,
+        "status": job["status"],
+        "progress": job["progress"],
+        "downloaded_bytes": job.get("downloaded", 0),
+        "total_bytes": job.get("total")
+    })
 
 @app.route("/file/<name>")
 def serve(name):
+    if not (name.endswith(".mp4") and is_job_id(name[:-4])):
+        return json_bytes(_NOT_FOUND, 404)
+
     path = os.path.join(DOWNLOAD_DIR, name)
-    if not path.endswith(".mp4") or not os.path.exists(path):
-        return jsonify({"error": "Not found"}), 404
+    if not os.path.exists(path):
+        return json_bytes(_NOT_FOUND, 404)
+
+    if X_ACCEL_PREFIX:
+        return Response(
+            mimetype="video/mp4",
+            headers={"X-Accel-Redirect": X_ACCEL_PREFIX + name}
+        )
 
-    return send_file(
+    # send_file hands the open file to wsgi.file_wrapper, so gunicorn
+    # streams it with sendfile(2) instead of copying through Python
+    resp = send_file(
         path,
         mimetype="video/mp4",
         as_attachment=False,
-        conditional=True
+        conditional=True,
+        etag=True,
+        max_age=FILE_LIFETIME
     )
+    # werkzeug only sets this on 206 replies; advertise it up front
+    # so players / WhatsApp know they can seek and resume
+    resp.headers["Accept-Ranges"] = "bytes"
+    # not immutable: a name is the video + format selector, not a content
+    # hash, and a re-download after expiry can differ; the mtime-based ETag
+    # lets clients revalidate once max_age runs out
+    return resp
 
 # =========================
 # RUN
@@ -195,4 +750,5 @@ def serve(name):
 
 if __name__ == "__main__":
     log.info(f"Server running on {PORT}")
-    app.run(host="0.0.0.0", port=PORT)
+    # dev server only; the background jobs need it to keep serving polls
+    app.run(host="0.0.0.0", port=PORT, threaded=True)